@@ -165,8 +165,10 @@ class Alignment(koruza.Application):
             if not state.get('sfp') or not state.get('motors'):
                 # Do nothing until we have known last state from SFP and motor drivers.
                 return
-            # Get last known state for the first SFP module.
-            sfp = state['sfp']['sfp'].values()[0]
+            # Get last known state for the primary SFP module.
+            sfp = self.get_sfp(state)
+            if sfp is None:
+                return
             # Get last known motor driver state.
             motor = state['motors']['motor']
 
@@ -188,9 +190,11 @@ class Alignment(koruza.Application):
                 print 'ERROR: No connection!'
 
             else:
-                # Get last known state for the first SFP module.
-                sfp = state['sfp']['sfp'].values()[0]
-                sfp_remote = remote_state['sfp']['sfp'].values()[0]
+                # Get last known state for the primary SFP modules.
+                sfp = self.get_sfp(state)
+                sfp_remote = self.get_sfp(remote_state)
+                if sfp is None or sfp_remote is None:
+                    return
                 # Get last known motor driver state.
                 motor = state['motors']['motor']
                 motor_remote = remote_state['motors']['motor']
@@ -708,7 +712,8 @@ class Alignment(koruza.Application):
             pass
 
 
-Alignment().start()
+if __name__ == '__main__':
+    Alignment().start()
 
 
 
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+import argparse
+import importlib
+import koruza
+
+parser = argparse.ArgumentParser(description="Runs several KORUZA applications in a single process.")
+parser.add_argument('modules', nargs='+', help="controller modules to load, for example 'alignment spiral_scan'")
+args = parser.parse_args()
+
+# Load all applications defined by the given controller modules.
+applications = []
+for name in args.modules:
+    module = importlib.import_module(name)
+    for value in vars(module).values():
+        if isinstance(value, type) and issubclass(value, koruza.Application) and value.__module__ == module.__name__:
+            applications.append(value())
+
+koruza.ApplicationHost(applications).start()
@@ -1,9 +1,606 @@
 import nnpy
 import select
+import copy
+import heapq
+import types
+import itertools
 import json
+import math
+import mmap
+import struct
 import traceback
 import time
 
+# Binary status encoding, see encode_status in koruza-sensors. The tables
+# must match the ones there, which is verified by 'koruza-benchmark check'.
+BINARY_HEADER = '<BBd'
+BINARY_TYPE_JSON = 0
+BINARY_TYPE_MOTORS = 1
+BINARY_TYPE_SFP = 2
+BINARY_TYPE_1WIRE = 3
+BINARY_MOTOR_FORMAT = '<llllllBBBBBBBBHH'
+BINARY_MOTOR_FIELDS = [
+    'next_x', 'next_y', 'next_f',
+    'current_x', 'current_y', 'current_f',
+    'status_x', 'status_y', 'status_f',
+    'empty', 'flash_status', 'flash_write_count',
+    'command', 'laser', 'speed', 'accel',
+]
+BINARY_SFP_FORMAT = '<7d'
+BINARY_SFP_FIELDS = [
+    'temperature_c', 'vcc_v', 'tx_bias_ma',
+    'tx_power_mw', 'tx_power_db', 'rx_power_mw', 'rx_power_db',
+]
+BINARY_1WIRE_FORMAT = '<d'
+
+
+def decode_status(payload):
+    """
+    Decodes a binary status update.
+
+    :param payload: Binary payload
+    :return: Status update in the same form as JSON-encoded updates, with
+      the time of publishing in 'published'
+    :raises ValueError: When the payload is malformed or truncated
+    :raises struct.error: When a record is truncated
+    """
+
+    version, payload_type, timestamp = struct.unpack_from(BINARY_HEADER, payload)
+    offset = struct.calcsize(BINARY_HEADER)
+
+    def read_count(offset):
+        if offset >= len(payload):
+            raise ValueError("Truncated binary payload.")
+
+        return ord(payload[offset])
+
+    def read_identifier(offset):
+        length = read_count(offset)
+        end = offset + 1 + length
+        if end > len(payload):
+            raise ValueError("Truncated binary payload.")
+
+        return payload[offset + 1:end], end
+
+    if payload_type == BINARY_TYPE_MOTORS:
+        values = struct.unpack_from(BINARY_MOTOR_FORMAT, payload, offset)
+        data = {
+            'type': 'motors',
+            'motor': dict(zip(BINARY_MOTOR_FIELDS, values)),
+        }
+    elif payload_type == BINARY_TYPE_SFP:
+        count = read_count(offset)
+        offset += 1
+        sfps = {}
+        for i in range(count):
+            serial, offset = read_identifier(offset)
+            values = struct.unpack_from(BINARY_SFP_FORMAT, payload, offset)
+            offset += struct.calcsize(BINARY_SFP_FORMAT)
+            sfps[serial] = dict(zip(BINARY_SFP_FIELDS, values))
+
+        data = {
+            'type': 'sfp',
+            'sfp': sfps,
+        }
+    elif payload_type == BINARY_TYPE_1WIRE:
+        count = read_count(offset)
+        offset += 1
+        devices = {}
+        for i in range(count):
+            device_id, offset = read_identifier(offset)
+            temperature, = struct.unpack_from(BINARY_1WIRE_FORMAT, payload, offset)
+            offset += struct.calcsize(BINARY_1WIRE_FORMAT)
+            devices[device_id] = {'temperature_c': temperature}
+
+        data = {
+            'type': '1wire',
+            'devices': devices,
+        }
+    elif payload_type == BINARY_TYPE_JSON:
+        length, = struct.unpack_from('<I', payload, offset)
+        offset += 4
+        data = json.loads(payload[offset:offset + length])
+    else:
+        raise ValueError("Unsupported binary payload type %d." % payload_type)
+
+    data['published'] = timestamp
+    return data
+
+
+# Shared-memory status board, see StatusBoard in koruza-sensors.
+STATUS_BOARD_FILE = '/dev/shm/koruza-status'
+STATUS_BOARD_MAGIC = 'KRZSTAT1'
+STATUS_BOARD_HEADER = '<8sIII'
+
+
+class StatusBoard(object):
+    """
+    Reader of the latest status values that koruza-sensors writes into
+    shared memory. Values are read directly from the mapping and retried
+    while koruza-sensors is updating them.
+    """
+
+    # Maximum number of attempts to obtain a consistent read.
+    MAX_RETRIES = 100
+
+    def __init__(self, filename=STATUS_BOARD_FILE):
+        """
+        Class constructor.
+
+        :param filename: Path to the status board file
+        """
+
+        self._filename = filename
+        self._map = self._open()
+        self._layout = None
+        self.fields = []
+
+    def _open(self):
+        with open(self._filename, 'rb') as board_file:
+            return mmap.mmap(board_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load_layout(self, layout, length):
+        # The board is resized when koruza-sensors restarts with different fields.
+        self._map = self._open()
+        offset = struct.calcsize(STATUS_BOARD_HEADER)
+        self.fields = self._map[offset:offset + length].split(',')
+        self._values = struct.Struct('<' + 'd' * (len(self.fields) + 1))
+        self._values_offset = (offset + length + 7) // 8 * 8
+        self._layout = layout
+
+    def read(self, *fields):
+        """
+        Returns the latest status values.
+
+        :param fields: Names of fields to return, all fields when omitted
+        :return: A dictionary mapping field names to values (None when not
+          yet available) and 'time' to the time of the last update, or None
+          when no consistent read could be made
+        """
+
+        for attempt in xrange(StatusBoard.MAX_RETRIES):
+            magic, layout, sequence, length = struct.unpack_from(STATUS_BOARD_HEADER, self._map)
+            if magic != STATUS_BOARD_MAGIC or sequence & 1:
+                continue
+
+            if layout != self._layout:
+                self._load_layout(layout, length)
+                continue
+
+            values = self._values.unpack_from(self._map, self._values_offset)
+            if struct.unpack_from(STATUS_BOARD_HEADER, self._map)[2] == sequence:
+                break
+        else:
+            return None
+
+        result = {'time': values[0]}
+        for name, value in zip(self.fields, values[1:]):
+            if fields and name not in fields:
+                continue
+
+            result[name] = None if math.isnan(value) else value
+
+        return result
+
+
+def merge_state(state, update, copy_values=False):
+    """
+    Merges a delta status update into a status dictionary. This is also used
+    by koruza-sensors and koruza-nodewatcher.
+
+    :param state: Status dictionary to update in place
+    :param update: Delta status update
+    :param copy_values: Should values be copied, so that the state does not
+      share lists with the update
+    """
+
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(state.get(key), dict):
+            merge_state(state[key], value, copy_values)
+        else:
+            state[key] = copy.deepcopy(value) if copy_values else value
+
+
+def merge_update(state, data):
+    """
+    Merges a status update into a status dictionary.
+
+    :param state: Status dictionary to update in place
+    :param data: Status update
+    :return: Full status of the update's type or None when a delta update
+      is received before a full snapshot
+    """
+
+    if data.pop('delta', False):
+        # Delta updates are merged into the last full snapshot.
+        if data['type'] not in state:
+            return None
+
+        merge_state(state[data['type']], data)
+        return state[data['type']]
+
+    state[data['type']] = data
+    return data
+
+
+def receive_messages(socket):
+    """
+    Receives and decodes all queued messages.
+
+    :param socket: Subscriber socket
+    :return: Generator of topic and payload pairs
+    """
+
+    while True:
+        try:
+            topic, payload = socket.recv(nnpy.DONTWAIT).split('@', 1)
+        except AssertionError:
+            break
+
+        try:
+            if topic == 'binary.status':
+                data = decode_status(payload)
+            else:
+                data = json.loads(payload)
+        except (ValueError, struct.error):
+            continue
+
+        yield topic, data
+
+
+class StatusRecord(object):
+    """
+    Latest status of a single device. Fields are updated in place and the
+    time each field was last received is kept alongside.
+    """
+
+    __slots__ = ('updated', 'field_times')
+
+    # Names of status fields and their indices in field_times.
+    FIELDS = []
+    INDEX = {}
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        self.updated = None
+        self.field_times = [None] * len(self.FIELDS)
+
+    def update(self, data, now):
+        """
+        Updates fields from a (possibly partial) status update.
+
+        :param data: A dictionary of field values
+        :param now: Time of reception
+        """
+
+        for field, value in data.iteritems():
+            index = self.INDEX.get(field)
+            if index is None:
+                continue
+
+            setattr(self, field, value)
+            self.field_times[index] = now
+
+        self.updated = now
+
+    def age(self, field=None):
+        """
+        Returns the time (in seconds) since the record or one of its fields
+        was last updated, None when it has never been updated.
+
+        :param field: Optional field name
+        """
+
+        updated = self.updated if field is None else self.field_times[self.INDEX[field]]
+        if updated is None:
+            return None
+
+        return time.time() - updated
+
+    def is_stale(self, max_age, field=None):
+        """
+        Returns True when the record or one of its fields has not been
+        updated for more than max_age seconds.
+        """
+
+        age = self.age(field)
+        return age is None or age > max_age
+
+
+class MotorStatus(StatusRecord):
+    __slots__ = tuple(BINARY_MOTOR_FIELDS)
+
+    FIELDS = BINARY_MOTOR_FIELDS
+    INDEX = dict((field, index) for index, field in enumerate(FIELDS))
+
+    @property
+    def moving(self):
+        return bool(self.status_x or self.status_y or self.status_f)
+
+
+class SFPStatus(StatusRecord):
+    __slots__ = tuple(BINARY_SFP_FIELDS) + ('serial', 'bus', 'role')
+
+    FIELDS = BINARY_SFP_FIELDS
+    INDEX = dict((field, index) for index, field in enumerate(FIELDS))
+
+    def __init__(self, serial):
+        super(SFPStatus, self).__init__()
+        self.serial = serial
+        self.bus = None
+        self.role = None
+
+
+class OneWireStatus(StatusRecord):
+    __slots__ = ('device_id', 'temperature_c')
+
+    FIELDS = ['temperature_c']
+    INDEX = {'temperature_c': 0}
+
+    def __init__(self, device_id):
+        super(OneWireStatus, self).__init__()
+        self.device_id = device_id
+
+
+class StatusStore(object):
+    """
+    Typed view of the latest status of a unit, kept alongside the merged
+    status dictionaries for applications that enable it. Records give
+    attribute access to status values and remember when each field was last
+    received.
+    """
+
+    __slots__ = ('motor', 'sfp', 'onewire', 'app_status', 'app_status_times', '_primary_sfp', '_snapshots')
+
+    def __init__(self):
+        self.motor = None
+        self.sfp = {}
+        self.onewire = {}
+        self.app_status = {}
+        self.app_status_times = {}
+        self._primary_sfp = None
+        # Update types for which a full snapshot has been received.
+        self._snapshots = set()
+
+    def update(self, update, now):
+        """
+        Updates records from a decoded status update.
+
+        :param update: Full or delta status update
+        :param now: Time of reception
+        """
+
+        update_type = update.get('type')
+        full = not update.get('delta', False)
+        if full:
+            self._snapshots.add(update_type)
+        elif update_type not in self._snapshots:
+            # Deltas are ignored until a full snapshot is received, as they
+            # are by merge_update.
+            return
+
+        if update_type == 'motors':
+            if 'motor' in update:
+                if self.motor is None:
+                    self.motor = MotorStatus()
+                self.motor.update(update['motor'], now)
+        elif update_type == 'sfp':
+            readings = update.get('sfp', {})
+            if full and set(self.sfp) - set(readings):
+                # Full snapshots do not contain removed modules.
+                for serial in set(self.sfp) - set(readings):
+                    del self.sfp[serial]
+                self._primary_sfp = None
+
+            for serial, reading in readings.iteritems():
+                record = self.sfp.get(serial)
+                if record is None:
+                    record = self.sfp[serial] = SFPStatus(serial)
+                    self._primary_sfp = None
+                record.update(reading, now)
+
+            for module in update.get('metadata', []):
+                record = self.sfp.get(module.get('serial'))
+                if record is not None and (record.bus, record.role) != (module.get('bus'), module.get('role')):
+                    record.bus = module.get('bus')
+                    record.role = module.get('role')
+                    self._primary_sfp = None
+        elif update_type == '1wire':
+            for device_id, reading in update.get('devices', {}).iteritems():
+                record = self.onewire.get(device_id)
+                if record is None:
+                    record = self.onewire[device_id] = OneWireStatus(device_id)
+                record.update(reading, now)
+
+    def update_app_status(self, values, now):
+        """
+        Updates application status values.
+
+        :param values: A dictionary of status values
+        :param now: Time of reception
+        """
+
+        self.app_status.update(values)
+        for key in values:
+            self.app_status_times[key] = now
+
+    def get_sfp(self, serial=None, role=None):
+        """
+        Returns the status record of an SFP module, selected the same way as
+        by Application.get_sfp, or None when the module is not present.
+        """
+
+        if serial is not None:
+            return self.sfp.get(serial)
+
+        if role is not None:
+            modules = [module for module in self.sfp.values() if module.role == role]
+            return min(modules, key=lambda module: (module.bus, module.serial)) if modules else None
+
+        if self._primary_sfp is None and self.sfp:
+            modules = [module for module in self.sfp.values() if module.role == 'primary'] or self.sfp.values()
+            self._primary_sfp = min(modules, key=lambda module: (module.bus, module.serial))
+
+        return self._primary_sfp
+
+    def app_status_age(self, key):
+        """
+        Returns the time (in seconds) since an application status value was
+        last updated, None when it has never been updated.
+        """
+
+        updated = self.app_status_times.get(key)
+        if updated is None:
+            return None
+
+        return time.time() - updated
+
+    @property
+    def current_x(self):
+        return self.motor.current_x if self.motor is not None else None
+
+    @property
+    def current_y(self):
+        return self.motor.current_y if self.motor is not None else None
+
+    @property
+    def rx_power_db(self):
+        sfp = self.get_sfp()
+        return sfp.rx_power_db if sfp is not None else None
+
+    @property
+    def rx_power_mw(self):
+        sfp = self.get_sfp()
+        return sfp.rx_power_mw if sfp is not None else None
+
+
+class Latency(object):
+    """
+    Summary of measured latencies.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def serialize(self, reset=False):
+        """
+        Returns the number of measurements and their mean, minimum and
+        maximum (in seconds).
+
+        :param reset: Should measurements be reset after being serialized
+        """
+
+        data = {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+        }
+
+        if reset:
+            self.reset()
+
+        return data
+
+
+class Future(object):
+    """
+    Result of an operation that completes in the application loop.
+    """
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self._callbacks = []
+
+    def set_result(self, result):
+        self.done = True
+        self.result = result
+        for callback in self._callbacks:
+            callback(self)
+        self._callbacks = []
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+
+def gather(futures):
+    """
+    Returns a future that completes with a list of results once all given
+    futures complete.
+
+    :param futures: List of futures
+    """
+
+    result = Future()
+    pending = [len(futures)]
+
+    def complete(future):
+        pending[0] -= 1
+        if not pending[0]:
+            result.set_result([future.result for future in futures])
+
+    if not futures:
+        result.set_result([])
+    for future in futures:
+        future.add_done_callback(complete)
+
+    return result
+
+
+def run_coroutine(coroutine):
+    """
+    Runs a generator-based coroutine in the application loop. The coroutine
+    may yield a future or a list of futures and is resumed with the result
+    once they complete.
+
+    :param coroutine: Generator
+    :return: Future that completes when the coroutine returns
+    """
+
+    done = Future()
+
+    def step(value):
+        while True:
+            try:
+                waiting = coroutine.send(value)
+            except StopIteration:
+                done.set_result(None)
+                return
+            except Exception:
+                traceback.print_exc()
+                done.set_result(None)
+                return
+
+            if isinstance(waiting, list):
+                waiting = gather(waiting)
+            if not isinstance(waiting, Future):
+                value = waiting
+            elif waiting.done:
+                value = waiting.result
+            else:
+                waiting.add_done_callback(lambda future: step(future.result))
+                return
+
+    step(None)
+    return done
+
 
 class Bus(object):
     def __init__(self):
@@ -23,31 +620,156 @@ class Bus(object):
             return None
 
 
+class AsyncBus(object):
+    """
+    Command bus that does not block the application loop. Commands return
+    futures and any number of commands may be in flight, each using its own
+    REQ socket; sockets are reused once their reply has been received.
+    """
+
+    # Time (in seconds) to wait for a reply.
+    TIMEOUT = 30
+
+    def __init__(self, poll, application):
+        """
+        Class constructor.
+
+        :param poll: Poll object of the application loop
+        :param application: Application whose timers are used for timeouts
+        """
+
+        self._poll = poll
+        self._application = application
+        self._idle = []
+        self._pending = {}
+
+    def command(self, command, reply_timeout=TIMEOUT, **data):
+        """
+        Sends a command.
+
+        :param command: Command name
+        :param reply_timeout: Time (in seconds) to wait for a reply
+        :return: Future that completes with the reply or None when the reply
+          is malformed or does not arrive in time
+        """
+
+        data.update({
+            'type': 'command',
+            'command': command,
+        })
+
+        if self._idle:
+            socket, fd = self._idle.pop()
+        else:
+            socket = nnpy.Socket(nnpy.AF_SP, nnpy.REQ)
+            socket.connect('ipc:///tmp/koruza-command.ipc')
+            fd = socket.getsockopt(nnpy.SOL_SOCKET, nnpy.RCVFD)
+
+        future = Future()
+        socket.send(json.dumps(data))
+        timer = self._application.call_later(reply_timeout, lambda bus, state, remote_state: self._expire(fd))
+        self._pending[fd] = (socket, future, timer)
+        self._poll.register(fd, select.POLLIN)
+        return future
+
+    def _expire(self, fd):
+        """
+        Completes a command whose reply did not arrive in time. Its socket is
+        closed, as a late reply would otherwise be received by the next
+        command.
+
+        :param fd: Descriptor of the command's socket
+        """
+
+        socket, future, timer = self._pending.pop(fd)
+        self._poll.unregister(fd)
+        socket.close()
+        future.set_result(None)
+
+    def process(self, fd):
+        """
+        Receives a reply when one is available on the given descriptor.
+
+        :param fd: Descriptor with activity
+        :return: True if the descriptor belongs to this bus
+        """
+
+        if fd not in self._pending:
+            return False
+
+        socket, future, timer = self._pending[fd]
+        try:
+            reply = socket.recv(nnpy.DONTWAIT)
+        except AssertionError:
+            return True
+
+        del self._pending[fd]
+        self._application.cancel_timer(timer)
+        self._poll.unregister(fd)
+        self._idle.append((socket, fd))
+
+        try:
+            future.set_result(json.loads(reply))
+        except ValueError:
+            future.set_result(None)
+
+        return True
+
+
 class Application(object):
+    # Status encoding format, either 'json' or 'binary'. The binary format
+    # requires the 'publish_binary' configuration option to be enabled.
+    FORMAT_JSON = 'json'
+    FORMAT_BINARY = 'binary'
+    # Interval (in seconds) between attempts to open the status board.
+    STATUS_BOARD_RETRY_INTERVAL = 5
+
     application_id = None
     needs_remote = False
+    status_format = FORMAT_JSON
+    # In reactive mode on_idle is not called. Instead, handlers registered
+    # with on_update are called when status changes and timers registered
+    # with call_later when they are due.
+    reactive = False
+    # Should typed status stores be kept in self.status and
+    # self.remote_status. Applications that do not use them pay nothing.
+    status_store = False
 
     def __init__(self):
         self._topic = 'application.%s' % self.application_id
+        self._status_topic = 'binary.status' if self.status_format == Application.FORMAT_BINARY else 'status'
         self.config = {}
+        # Latest status values in shared memory, opened on first use.
+        self._status_board = None
+        self._status_board_retry = 0
+        self._handlers = []
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        # Application status set during the current loop iteration.
+        self._pending_status = {}
+        self._status_socket = None
+        # Time from publishing a local status update to calling its handlers.
+        self.reaction_latency = Latency()
 
     def start(self):
         # Establish IPC connections.
         publish = nnpy.Socket(nnpy.AF_SP, nnpy.SUB)
         publish.connect('ipc:///tmp/koruza-publish.ipc')
-        publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, 'status')
+        publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, self._status_topic)
         publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, self._topic)
+        # Configuration changes are announced as events.
+        publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, 'config')
         publish_fd = publish.getsockopt(nnpy.SOL_SOCKET, nnpy.RCVFD)
 
-        command_bus = Bus()
-        self._command_bus = command_bus
-
         poll = select.poll()
         poll.register(publish_fd, select.POLLIN)
 
-        last_state = {}
-        last_remote_state = {}
-        last_remote_ip_check = 0
+        # Application status is pushed to koruza-sensors without waiting for a reply.
+        status_socket = nnpy.Socket(nnpy.AF_SP, nnpy.PUSH)
+        status_socket.connect('ipc:///tmp/koruza-applications.ipc')
+
+        command_bus = Bus()
+        self.attach(command_bus, status_socket, poll)
 
         remote_ip = None
         remote_publish = None
@@ -55,88 +777,346 @@ class Application(object):
 
         # Get initial configuration.
         self.config = command_bus.command('get_status')['config']
+        # Request full status snapshots in case status updates are published as deltas.
+        command_bus.command('publish_snapshot')
+
+        self._call(self.on_start, self._bus, self._state, self._remote_state)
 
         while True:
-            now = time.time()
+            # Send application status set during the previous iteration as a
+            # single update before waiting.
+            self.flush()
 
-            # Check for incoming updates, block for at most 100 ms.
-            for fd, event in poll.poll(100):
+            # Check for incoming updates, block for at most 100 ms unless in
+            # reactive mode, where we only wake up for the next timer.
+            events = poll.poll(self.get_timeout())
+            now = time.time()
+            for fd, event in events:
                 if fd == publish_fd:
                     socket = publish
                     remote = False
                 elif fd == remote_publish_fd:
                     socket = remote_publish
                     remote = True
+                else:
+                    self._process_fd(fd)
+                    continue
 
-                while True:
-                    try:
-                        topic, payload = socket.recv(nnpy.DONTWAIT).split('@', 1)
-                    except AssertionError:
-                        break
-
+                for topic, data in receive_messages(socket):
                     try:
-                        data = json.loads(payload)
-                    except ValueError:
-                        continue
+                        published = None
+                        if topic == self._status_topic:
+                            topic = 'status'
+                            published = data.pop('published', None)
+                            store = self.remote_status if remote else self.status
+                            if store is not None:
+                                store.update(data, now)
+                            data = merge_update(self._remote_state if remote else self._state, data)
+                            if data is None:
+                                continue
 
-                    try:
-                        if topic == self._topic:
-                            if data['type'] == 'command' and not remote:
-                                self.on_command(command_bus, data, last_state, last_remote_state)
-                            elif data['type'] == 'app_status':
-                                state = last_remote_state if remote else last_state
-                                state.setdefault('app_status', {}).update(data['value'])
-
-                                for key in data['value']:
-                                    state.setdefault('_age', {}).setdefault('app_status', {})[key] = now
-                        elif topic == 'status':
-                            if remote:
-                                last_remote_state[data['type']] = data
-                                last_remote_state.setdefault('_age', {})[data['type']] = now
-                                self.on_remote_status_update(command_bus, data)
-                            else:
-                                last_state[data['type']] = data
-                                last_state.setdefault('_age', {})[data['type']] = now
-                                self.on_status_update(command_bus, data)
+                        self.receive(topic, data, remote, now, published)
                     except:
                         traceback.print_exc()
 
+            self.run_timers()
+
             # Run local processing.
-            self.on_idle(command_bus, last_state, last_remote_state)
+            if not self.reactive:
+                self._call(self.on_idle, self._bus, self._state, self._remote_state)
 
             # Check for remote IP change.
-            if self.needs_remote and now - last_remote_ip_check > 30:
-                # Request configuration to discover the remote IP.
-                status = command_bus.command('get_status')
-                self.config = status['config']
-                next_remote_ip = self.config.get('remote_ip', None)
-                last_remote_ip_check = now
-                if not next_remote_ip or next_remote_ip.startswith('127.') or next_remote_ip == remote_ip:
+            next_remote_ip = self.get_remote_ip()
+            if next_remote_ip is None or next_remote_ip == remote_ip:
+                continue
+
+            remote_ip = next_remote_ip
+            if remote_publish is not None:
+                remote_publish.close()
+                poll.unregister(remote_publish_fd)
+                remote_publish_fd = None
+
+            remote_publish = nnpy.Socket(nnpy.AF_SP, nnpy.SUB)
+            remote_publish.connect('tcp://%s:7100' % str(next_remote_ip))
+            remote_publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, self._status_topic)
+            remote_publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, self._topic)
+            remote_publish_fd = remote_publish.getsockopt(nnpy.SOL_SOCKET, nnpy.RCVFD)
+            poll.register(remote_publish_fd, select.POLLIN)
+
+    def attach(self, command_bus, status_socket, poll):
+        """
+        Attaches the application to IPC connections, which may be shared
+        with other applications in the same process.
+
+        :param command_bus: Blocking command bus
+        :param status_socket: Socket for pushing application status
+        :param poll: Poll object of the application loop
+        """
+
+        self._command_bus = command_bus
+        self._status_socket = status_socket
+        self._bus = self._create_bus(poll)
+        self._state = {}
+        self._remote_state = {}
+        # Typed status stores of the local and the remote unit, when enabled.
+        self.status = StatusStore() if self.status_store else None
+        self.remote_status = StatusStore() if self.status_store else None
+        # The remote IP is checked on start and after configuration changes.
+        self._check_remote_ip = True
+
+    @property
+    def status_board(self):
+        """
+        Reader of the latest status values in shared memory or None while
+        koruza-sensors has not created the status board yet. Opening is
+        retried at most every STATUS_BOARD_RETRY_INTERVAL seconds.
+        """
+
+        if self._status_board is None and time.time() >= self._status_board_retry:
+            self._status_board_retry = time.time() + Application.STATUS_BOARD_RETRY_INTERVAL
+            try:
+                self._status_board = StatusBoard()
+            except (IOError, ValueError, mmap.error):
+                pass
+
+        return self._status_board
+
+    def receive(self, topic, data, remote, now, published=None):
+        """
+        Handles a decoded message. Status updates must already be merged
+        with previous updates of the same type.
+
+        :param topic: Message topic, 'status' for all status updates
+        :param data: Message payload
+        :param remote: Was the message received from the remote unit
+        :param now: Time of reception
+        :param published: Time the status update was published
+        """
+
+        state = self._remote_state if remote else self._state
+        if topic == 'config':
+            if data['type'] == 'event' and data['event'] == 'config_changed' and not remote:
+                self.config = data['config']
+                self._check_remote_ip = True
+        elif topic == self._topic:
+            if data['type'] == 'command' and not remote:
+                self._call(self.on_command, self._bus, data, self._state, self._remote_state)
+            elif data['type'] == 'app_status':
+                state.setdefault('app_status', {}).update(data['value'])
+                store = self.remote_status if remote else self.status
+                if store is not None:
+                    store.update_app_status(data['value'], now)
+
+                for key in data['value']:
+                    state.setdefault('_age', {}).setdefault('app_status', {})[key] = now
+
+                self._dispatch(self._bus, 'app_status', state['app_status'], remote,
+                               self._state, self._remote_state)
+        elif topic == 'status':
+            state[data['type']] = data
+            state.setdefault('_age', {})[data['type']] = now
+            if remote:
+                self._call(self.on_remote_status_update, self._bus, data)
+            else:
+                self._call(self.on_status_update, self._bus, data)
+
+            if self._dispatch(self._bus, data['type'], data, remote, self._state,
+                              self._remote_state) and published is not None and not remote:
+                self.reaction_latency.add(time.time() - published)
+
+    def get_timeout(self):
+        """
+        Returns the time (in milliseconds) the application loop may wait for
+        messages, -1 when it may wait indefinitely.
+        """
+
+        timeout = -1 if self.reactive else 100
+        if self._timers:
+            until_timer = max(0, int(math.ceil((self._timers[0][0] - time.time()) * 1000)))
+            timeout = until_timer if timeout < 0 else min(timeout, until_timer)
+
+        return timeout
+
+    def run_timers(self):
+        """
+        Runs due timers.
+        """
+
+        while self._timers and self._timers[0][0] <= time.time():
+            deadline, _, callback = heapq.heappop(self._timers)
+            if callback is None:
+                continue
+
+            try:
+                self._call(callback, self._bus, self._state, self._remote_state)
+            except:
+                traceback.print_exc()
+
+    def get_remote_ip(self):
+        """
+        Returns the remote IP when it should be (re)checked, otherwise None.
+        """
+
+        if not self.needs_remote or not self._check_remote_ip:
+            return None
+
+        self._check_remote_ip = False
+        remote_ip = self.config.get('remote_ip', None)
+        if not remote_ip or remote_ip.startswith('127.'):
+            return None
+
+        return remote_ip
+
+    def _create_bus(self, poll):
+        # Returns the command bus that is passed to handlers.
+        return self._command_bus
+
+    def _process_fd(self, fd):
+        # Handles activity on descriptors registered by subclasses.
+        pass
+
+    def _call(self, function, *args):
+        # Calls a handler.
+        return function(*args)
+
+    def on_update(self, callback, update_type=None, fields=None, remote=False):
+        """
+        Registers a handler of status updates.
+
+        :param callback: Function that is called with the command bus, the
+          update and the local and remote state
+        :param update_type: Only handle updates of this type, for example
+          'motors', 'sfp' or 'app_status'
+        :param fields: Only handle updates that change one of these fields,
+          given as keys or tuples of keys into the update, for example
+          ('motor', 'current_x')
+        :param remote: Should updates from the remote unit be handled
+          instead of local ones
+        """
+
+        self._handlers.append({
+            'callback': callback,
+            'type': update_type,
+            'fields': [field if isinstance(field, tuple) else (field,) for field in fields or []],
+            'remote': remote,
+            'values': None,
+        })
+
+    def _dispatch(self, bus, update_type, update, remote, state, remote_state):
+        # Calls handlers matching a status update, returns True if any were called.
+        called = False
+        for handler in self._handlers:
+            if handler['remote'] != remote or handler['type'] not in (None, update_type):
+                continue
+
+            if handler['fields']:
+                values = []
+                for path in handler['fields']:
+                    value = update
+                    for key in path:
+                        value = value.get(key) if isinstance(value, dict) else None
+                    values.append(value)
+
+                if values == handler['values']:
                     continue
-                else:
-                    remote_ip = next_remote_ip
 
-                if remote_publish is not None:
-                    remote_publish.close()
-                    poll.unregister(remote_publish_fd)
-                    remote_publish_fd = None
+                handler['values'] = values
+
+            called = True
+            self._call(handler['callback'], bus, update, state, remote_state)
+
+        return called
+
+    def call_at(self, deadline, callback):
+        """
+        Registers a timer.
+
+        :param deadline: Time when the timer is due
+        :param callback: Function that is called with the command bus and the
+          local and remote state
+        :return: Timer that may be passed to cancel_timer
+        """
 
-                remote_publish = nnpy.Socket(nnpy.AF_SP, nnpy.SUB)
-                remote_publish.connect('tcp://%s:7100' % str(next_remote_ip))
-                remote_publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, 'status')
-                remote_publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, self._topic)
-                remote_publish_fd = remote_publish.getsockopt(nnpy.SOL_SOCKET, nnpy.RCVFD)
-                poll.register(remote_publish_fd, select.POLLIN)
+        timer = [deadline, next(self._timer_sequence), callback]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def call_later(self, delay, callback):
+        """
+        Registers a timer that is due after a delay (in seconds).
+        """
+
+        return self.call_at(time.time() + delay, callback)
+
+    def cancel_timer(self, timer):
+        if timer is not None:
+            timer[2] = None
 
     def publish(self, data):
-        self._command_bus.command(
-            'call_application',
-            application_id=self.application_id,
-            payload={
-                'type': 'app_status',
-                'value': data,
-            }
-        )
+        """
+        Sets application status values. Values set during one loop iteration
+        are sent together at the end of the iteration.
+
+        :param data: A dictionary of status values
+        """
+
+        self._pending_status.update(data)
+
+    def flush(self):
+        """
+        Sends pending application status values without waiting for them to
+        be delivered. Values are kept for the next attempt when they can not
+        be queued.
+        """
+
+        if not self._pending_status or self._status_socket is None:
+            return
+
+        message = '%s@%s' % (self._topic, json.dumps({
+            'type': 'app_status',
+            'value': self._pending_status,
+        }))
+
+        try:
+            self._status_socket.send(message, nnpy.DONTWAIT)
+        except AssertionError:
+            return
+
+        self._pending_status = {}
+
+    def get_sfp(self, state, serial=None, role=None):
+        """
+        Returns the last reading of an SFP module.
+
+        :param state: Local or remote state
+        :param serial: Serial number of the module
+        :param role: Role of the module, as set by the 'sfp_roles'
+          configuration option
+        :return: SFP reading or None when the module is not present
+
+        When neither serial nor role is given, the module with the 'primary'
+        role is returned, or the module on the lowest bus if there is none.
+        """
+
+        sfp_state = state.get('sfp', {})
+        readings = sfp_state.get('sfp', {})
+        if serial is not None:
+            return readings.get(serial)
+
+        # Metadata is ordered by bus, but is not available in binary updates.
+        modules = [module for module in sfp_state.get('metadata', []) if module['serial'] in readings]
+        if not modules:
+            modules = [{'serial': serial} for serial in sorted(readings)]
+
+        if role is not None:
+            modules = [module for module in modules if module.get('role') == role]
+        else:
+            modules = [module for module in modules if module.get('role') == 'primary'] or modules
+
+        if not modules:
+            return None
+
+        return readings[modules[0]['serial']]
 
     def get_age(self, state, *path):
         age = state.get('_age', {})
@@ -151,6 +1131,9 @@ class Application(object):
             else:
                 return time.time() - age
 
+    def on_start(self, bus, state, remote_state):
+        pass
+
     def on_idle(self, bus, state, remote_state):
         pass
 
@@ -162,3 +1145,199 @@ class Application(object):
 
     def on_remote_status_update(self, bus, update):
         pass
+
+
+class ApplicationHost(object):
+    """
+    Runs several applications in a single process. Messages are received
+    and decoded once and IPC connections are shared by all applications,
+    while exceptions and CPU time are tracked per application.
+    """
+
+    # Interval (in seconds) between reports of CPU time used by applications.
+    CPU_REPORT_INTERVAL = 300
+
+    def __init__(self, applications):
+        """
+        Class constructor.
+
+        :param applications: List of application instances
+        """
+
+        self.applications = applications
+        self.cpu_time = dict((application.application_id, 0.) for application in applications)
+
+    def _run(self, application, function, *args):
+        # Runs application code, isolating its exceptions from other applications.
+        started = time.clock()
+        try:
+            return function(*args)
+        except:
+            traceback.print_exc()
+        finally:
+            self.cpu_time[application.application_id] += time.clock() - started
+
+    def start(self):
+        applications = self.applications
+        status_topics = set(application._status_topic for application in applications)
+
+        # Establish IPC connections shared by all applications.
+        publish = nnpy.Socket(nnpy.AF_SP, nnpy.SUB)
+        publish.connect('ipc:///tmp/koruza-publish.ipc')
+        for topic in status_topics | set(application._topic for application in applications):
+            publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, topic)
+        publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, 'config')
+        publish_fd = publish.getsockopt(nnpy.SOL_SOCKET, nnpy.RCVFD)
+
+        poll = select.poll()
+        poll.register(publish_fd, select.POLLIN)
+
+        status_socket = nnpy.Socket(nnpy.AF_SP, nnpy.PUSH)
+        status_socket.connect('ipc:///tmp/koruza-applications.ipc')
+
+        # Status is merged once, keyed by status topic and origin.
+        states = {}
+        stores = {}
+
+        command_bus = Bus()
+        for application in applications:
+            application.attach(command_bus, status_socket, poll)
+            if application.status_store:
+                application.status = stores.setdefault((application._status_topic, False), StatusStore())
+                application.remote_status = stores.setdefault((application._status_topic, True), StatusStore())
+
+        remote_ip = None
+        remote_publish = None
+        remote_publish_fd = None
+
+        # Get initial configuration.
+        config = command_bus.command('get_status')['config']
+        # Request full status snapshots in case status updates are published as deltas.
+        command_bus.command('publish_snapshot')
+
+        for application in applications:
+            application.config = config
+            self._run(application, application._call, application.on_start, application._bus,
+                      application._state, application._remote_state)
+
+        last_report = time.time()
+
+        while True:
+            for application in applications:
+                self._run(application, application.flush)
+
+            timeouts = [application.get_timeout() for application in applications]
+            timeouts = [timeout for timeout in timeouts if timeout >= 0]
+            events = poll.poll(min(timeouts) if timeouts else -1)
+            now = time.time()
+            for fd, event in events:
+                if fd == publish_fd:
+                    socket = publish
+                    remote = False
+                elif fd == remote_publish_fd:
+                    socket = remote_publish
+                    remote = True
+                else:
+                    for application in applications:
+                        self._run(application, application._process_fd, fd)
+                    continue
+
+                for topic, data in receive_messages(socket):
+                    published = None
+                    if topic in status_topics:
+                        published = data.pop('published', None)
+                        store = stores.get((topic, remote))
+                        if store is not None:
+                            try:
+                                store.update(data, now)
+                            except (AttributeError, KeyError, TypeError):
+                                traceback.print_exc()
+
+                        try:
+                            data = merge_update(states.setdefault((topic, remote), {}), data)
+                        except (KeyError, TypeError):
+                            traceback.print_exc()
+                            continue
+
+                        if data is None:
+                            continue
+
+                    for application in applications:
+                        if remote and not application.needs_remote:
+                            continue
+
+                        if topic == application._status_topic:
+                            self._run(application, application.receive, 'status', data, remote, now, published)
+                        elif topic == application._topic or topic == 'config':
+                            self._run(application, application.receive, topic, data, remote, now)
+
+            for application in applications:
+                self._run(application, application.run_timers)
+                if not application.reactive:
+                    self._run(application, application._call, application.on_idle, application._bus,
+                              application._state, application._remote_state)
+
+            if now - last_report > ApplicationHost.CPU_REPORT_INTERVAL:
+                last_report = now
+                print "CPU time:", ", ".join(
+                    "%s %.2f s" % (application_id, cpu_time) for application_id, cpu_time in sorted(self.cpu_time.items())
+                )
+
+            # Check for remote IP change.
+            next_remote_ip = None
+            for application in applications:
+                next_remote_ip = self._run(application, application.get_remote_ip) or next_remote_ip
+            if next_remote_ip is None or next_remote_ip == remote_ip:
+                continue
+
+            remote_ip = next_remote_ip
+            if remote_publish is not None:
+                remote_publish.close()
+                poll.unregister(remote_publish_fd)
+                remote_publish_fd = None
+
+            remote_publish = nnpy.Socket(nnpy.AF_SP, nnpy.SUB)
+            remote_publish.connect('tcp://%s:7100' % str(next_remote_ip))
+            for application in applications:
+                if application.needs_remote:
+                    remote_publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, application._status_topic)
+                    remote_publish.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, application._topic)
+            remote_publish_fd = remote_publish.getsockopt(nnpy.SOL_SOCKET, nnpy.RCVFD)
+            poll.register(remote_publish_fd, select.POLLIN)
+
+
+class AsyncApplication(Application):
+    """
+    Application whose handlers may be generator-based coroutines. Handlers
+    receive an AsyncBus, so commands do not block processing of other
+    updates:
+
+        def on_command(self, bus, command, state, remote_state):
+            status = yield bus.command('get_status')
+            yield self.sleep(1)
+    """
+
+    reactive = True
+
+    def _create_bus(self, poll):
+        self._async_bus = AsyncBus(poll, self)
+        return self._async_bus
+
+    def _process_fd(self, fd):
+        self._async_bus.process(fd)
+
+    def _call(self, function, *args):
+        result = function(*args)
+        if isinstance(result, types.GeneratorType):
+            return run_coroutine(result)
+
+        return result
+
+    def sleep(self, delay):
+        """
+        Returns a future that completes after a delay (in seconds).
+        """
+
+        future = Future()
+        self.call_later(delay, lambda bus, state, remote_state: future.set_result(None))
+        return future
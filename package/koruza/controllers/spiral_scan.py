@@ -9,6 +9,8 @@ class SpiralScan(koruza.Application):
     application_id = 'spiral_scan'
     # Should be true if the application would like to access the remote unit.
     needs_remote = True
+    # Keep typed status stores, used to read the SFP module and motor status.
+    status_store = True
 
     # Current state.
     state = 'idle'
@@ -46,20 +48,19 @@ class SpiralScan(koruza.Application):
 
     def on_idle(self, bus, state, remote_state):
         if self.state == 'go':
-            if not state.get('sfp') or not state.get('motors'):
+            # Get last known state for the primary SFP module and the motor driver.
+            sfp = self.status.get_sfp()
+            motor = self.status.motor
+            if sfp is None or motor is None:
                 # Do nothing until we have known last state from SFP and motor drivers.
                 return
-            # Get last known state for the first SFP module.
-            sfp = state['sfp']['sfp'].values()[0]
-            # Get last known motor driver state.
-            motor = state['motors']['motor']
 
             # Check if motors stopped moving
-            if motor['status_x'] == 0 and motor['status_y'] == 0:
+            if motor.status_x == 0 and motor.status_y == 0:
 
                 # Calculate next points
-                x = motor['current_x'] + math.cos(self.angle) * self.step
-                y = motor['current_y'] + math.sin(self.angle) * self.step
+                x = motor.current_x + math.cos(self.angle) * self.step
+                y = motor.current_y + math.sin(self.angle) * self.step
 
                 # Request the motor to move to the next point.
                 bus.command('motor_move', next_x=x, next_y=y)
@@ -77,11 +78,12 @@ class SpiralScan(koruza.Application):
                     self.n_points = self.n_points + 1 # Increase nr. of points per line
 
                 # Check if some signal was detected and terminate the movement
-                if sfp['rx_power_mw'] > self.threshold:
+                if sfp.rx_power_mw > self.threshold:
                     self.state = 'idle'
                     print 'found optical power'
 
         elif self.state == 'idle':
             pass
 
-SpiralScan().start()
+if __name__ == '__main__':
+    SpiralScan().start()
@@ -36,8 +36,10 @@ class Test(koruza.Application):
             if not state.get('sfp') or not state.get('motors'):
                 # Do nothing until we have known last state from SFP and motor drivers.
                 return
-            # Get last known state for the first SFP module.
-            sfp = state['sfp']['sfp'].values()[0]
+            # Get last known state for the primary SFP module.
+            sfp = self.get_sfp(state)
+            if sfp is None:
+                return
             # Get last known motor driver state.
             motor = state['motors']['motor']
 
@@ -63,4 +65,5 @@ class Test(koruza.Application):
             pass
         
 
-Test().start()
+if __name__ == '__main__':
+    Test().start()
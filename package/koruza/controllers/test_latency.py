@@ -6,10 +6,12 @@ import time
 class TestLatency(koruza.Application):
     application_id = 'test_latency'
     needs_remote = True
+    reactive = True
 
     last_sent_seqno = None
     last_rcvd_seqno = None
     last_publish = None
+    retry_timer = None
 
     def measure(self, remote_state, update_publish=True, increment=True):
         if update_publish:
@@ -27,20 +29,29 @@ class TestLatency(koruza.Application):
         if update_publish or increment:
             print "Published:", self.last_sent_seqno, self.last_publish
 
-    def on_idle(self, bus, state, remote_state):
-        if remote_state.get('app_status', {}).get('sent_seqno', None) != self.last_rcvd_seqno:
-            self.last_rcvd_seqno = remote_state['app_status']['sent_seqno']
+            # Retry when there is no reply.
+            self.cancel_timer(self.retry_timer)
+            self.retry_timer = self.call_later(10, self.on_retry)
+
+    def on_start(self, bus, state, remote_state):
+        self.on_update(self.on_remote_app_status, 'app_status', remote=True)
+
+        self.last_sent_seqno = 0
+        self.measure(remote_state)
+
+    def on_remote_app_status(self, bus, app_status, state, remote_state):
+        if app_status.get('sent_seqno', None) != self.last_rcvd_seqno:
+            self.last_rcvd_seqno = app_status['sent_seqno']
             print "Got new measurement, republish", self.last_rcvd_seqno
             self.measure(remote_state, False, False)
 
-        if self.last_sent_seqno is None:
-            self.last_sent_seqno = 0
+        if app_status.get('rcvd_seqno', None) == self.last_sent_seqno:
+            print "Seq:", self.last_sent_seqno, "RTT:", time.time() - app_status['rcvd_time']
             self.measure(remote_state)
-        elif remote_state.get('app_status', {}).get('rcvd_seqno', None) == self.last_sent_seqno:
-            print "Seq:", self.last_sent_seqno, "RTT:", time.time() - remote_state['app_status']['rcvd_time']
-            self.measure(remote_state)
-        elif time.time() - self.last_publish > 10:
-            print "Retry after 10 sec.", remote_state.get('app_status')
-            self.measure(remote_state, increment=False)
 
-TestLatency().start()
+    def on_retry(self, bus, state, remote_state):
+        print "Retry after 10 sec.", remote_state.get('app_status')
+        self.measure(remote_state, increment=False)
+
+if __name__ == '__main__':
+    TestLatency().start()
@@ -24,13 +24,13 @@ class WebCam(koruza.Application):
             self.take_photo(bus)
 
         try:
-            rx_power = state['sfp']['sfp'].values()[0]['rx_power_db']
+            rx_power = self.get_sfp(state)['rx_power_db']
             if self.nominal_rx_power is None or rx_power > self.nominal_rx_power:
                 self.nominal_rx_power = rx_power
 
             if self.nominal_rx_power - rx_power < 6:
                 self.last_rx_power_nominal = now
-        except (IndexError, KeyError):
+        except (IndexError, KeyError, TypeError):
             return
 
         # If the power hasn't been nominal for more than 5 minutes.
@@ -83,4 +83,5 @@ class WebCam(koruza.Application):
             force_anon=True,
         )
 
-WebCam().start()
+if __name__ == '__main__':
+    WebCam().start()
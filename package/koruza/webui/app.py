@@ -241,7 +241,10 @@ def router(publisher):
 if __name__ == '__main__':
     publisher = nnpy.Socket(nnpy.AF_SP, nnpy.SUB)
     publisher.connect('ipc:///tmp/koruza-publish.ipc')
-    publisher.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, '')
+    # Only subscribe to JSON-encoded topics as those are forwarded to clients.
+    publisher.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, 'status')
+    publisher.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, 'process')
+    publisher.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, 'application.')
 
     command_bus = nnpy.Socket(nnpy.AF_SP, nnpy.REQ)
     command_bus.connect('ipc:///tmp/koruza-command.ipc')
@@ -1,5 +1,19 @@
 import _ from 'underscore';
 
+// Merges a delta status update into a status snapshot, returning a new object.
+function mergeState(state, update) {
+    let result = _.clone(state);
+    for (let key of _.keys(update)) {
+        if (_.isObject(update[key]) && !_.isArray(update[key]) && _.isObject(state[key])) {
+            result[key] = mergeState(state[key], update[key]);
+        } else {
+            result[key] = update[key];
+        }
+    }
+
+    return result;
+}
+
 class Subscription {
     constructor(bus, topic, types, handler) {
         this.bus = bus;
@@ -28,6 +42,7 @@ class Bus {
         this._socket.onmessage = (event) => {this._messageReceived(event)};
         this._socket.onopen = (event) => {this._processCommandQueue()};
         this._subscribers = {};
+        this._snapshots = {};
         this._commandQueue = [];
         this._authenticated = false;
         this._authenticationListeners = [];
@@ -141,6 +156,16 @@ class Bus {
             return;
 
         data = JSON.parse(data);
+        let snapshotKey = `${topic}@${data.type}`;
+        if (data.delta) {
+            // Delta updates only contain changed fields, merge them into the last full snapshot.
+            if (!this._snapshots[snapshotKey])
+                return;
+
+            data = mergeState(this._snapshots[snapshotKey], _.omit(data, 'delta'));
+        }
+        this._snapshots[snapshotKey] = data;
+
         for (let subscription of subscribers) {
             subscription.deliver(data);
         }